@@ -0,0 +1,147 @@
+"""
+Benchmarks for the playlist build on synthetic libraries.
+
+Creates tiny ID3-tagged MP3 stubs with a realistic tag distribution, times each stage of the build and writes the results to JSON.
+Compare two result files with `--compare`.
+
+    python benchmark.py --sizes 50 200 1000 --output bench.json
+    python benchmark.py --sizes 50 200 1000 --output new.json --compare bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from mutagen.id3 import ID3, TIT2, TPE1, TCON, COMM
+
+from html_gen.generate import generate_playlist_html
+from order_opt.local_search import local_search
+from order_opt.simulated_annealing import compute_weight_matrix, compute_total_loss, greedy_fill, simulated_annealing
+from process_mp3.cache import FileCache
+from process_mp3.tracks import tracks_from_files, slugify
+
+GENRES = ["Classical", "Jazz", "Ambient", "Electronic", "Folk", "Rock", "Soundtrack", "Pop", "Hip Hop", "World"]
+WORDS = ["night", "river", "dream", "light", "rain", "piano", "summer", "morning", "city", "waltz", "suite", "blue",
+         "dance", "road", "home", "winter", "song", "heart", "ocean", "fire", "garden", "star", "theme", "march"]
+# MPEG-1 Layer III, 128 kbit/s, 44.1 kHz, no padding: 417 byte frames
+SILENT_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+
+
+def zipf_choice(rng: random.Random, items: list, s=1.1):
+    weights = [1 / (k + 1) ** s for k in range(len(items))]
+    return rng.choices(items, weights)[0]
+
+
+def create_library(directory: Path, n: int, seed=0) -> list[Path]:
+    """ Write `n` MP3 stubs named like the source playlists (`artist - title.mp3`). Artists and genres follow a Zipf distribution. """
+    rng = random.Random(seed)
+    artists = [f"{rng.choice(WORDS)}-{rng.choice(WORDS)}{k}" for k in range(max(3, n // 8))]
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n):
+        artist = zipf_choice(rng, artists)
+        title = " ".join(rng.sample(WORDS, rng.randint(1, 3))).title() + f" {i}"
+        path = directory / f"{artist} - {slugify(title)}.mp3"
+        path.write_bytes(SILENT_FRAME * 8)
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text=title))
+        tags.add(TPE1(encoding=3, text=artist))
+        tags.add(TCON(encoding=3, text=zipf_choice(rng, GENRES)))
+        tags.add(COMM(lang='eng', text=f"https://example.org/{slugify(artist)}/{i}"))
+        tags.save(path)
+        paths.append(path)
+    return paths
+
+
+def timed(results: dict, name: str, fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        value = fn(*args, **kwargs)
+    results[name] = time.perf_counter() - t0
+    return value
+
+
+def benchmark_size(n: int, work_dir: Path, anneal_max: int, local_search_max: int, seed=0) -> dict:
+    lib_dir = work_dir / f"lib-{n}"
+    paths = create_library(lib_dir, n, seed)
+    times = {}
+    result = {'n': n, 'times': times}
+    cache = FileCache(work_dir / f"metadata-{n}.jsonl")
+    tracks = timed(times, 'scan_cold', tracks_from_files, paths, "Benchmark", cache)
+    cache.save()
+    cache = FileCache(work_dir / f"metadata-{n}.jsonl")
+    timed(times, 'scan_cached', tracks_from_files, paths, "Benchmark", cache)
+    weights = timed(times, 'weight_matrix', compute_weight_matrix, tracks)
+    result['nnz'] = int(weights.nnz)
+    ordered = ordered_greedy = timed(times, 'greedy_fill', greedy_fill, [None] * n, tracks, seed)
+    greedy_loss = compute_total_loss(compute_weight_matrix(ordered), list(range(n)))
+    result['greedy_loss_per_element'] = greedy_loss / n
+    if n <= local_search_max:
+        _, loss = timed(times, 'local_search', local_search, ordered)
+        result['local_search_loss_per_element'] = loss / n
+    if n <= anneal_max:
+        t0, best = time.perf_counter(), [float('inf'), 0.]
+
+        def progress(temp: float, loss_per_element: float, acceptance_rate: float):
+            if loss_per_element < best[0]:
+                best[:] = loss_per_element, time.perf_counter() - t0
+
+        ordered, loss = timed(times, 'simulated_annealing', simulated_annealing, ordered, iterations_per_temp=2 * n, seed=seed, progress=progress)
+        result['anneal_loss_per_element'] = loss / n
+        result['anneal_time_to_best'] = best[1]
+        _, loss = timed(times, 'simulated_annealing_adaptive', simulated_annealing, ordered_greedy, iterations_per_temp=2 * n, seed=seed, adaptive=True, patience=300)
+        result['adaptive_loss_per_element'] = loss / n
+    playlist_dir = work_dir / f"playlists-{n}"
+    playlist_dir.mkdir(exist_ok=True)
+    tracks_data = [{"name": t.display_name, "full": t.long_name, "url": t.get_output_filename(i), "start": 0., "end": None, "source": t.url} for i, t in enumerate(ordered, 1)]
+    (playlist_dir / "Benchmark.json").write_text(json.dumps({'majorVersion': 1, 'minorVersion': 0, 'tracks': tracks_data}), encoding='utf-8')
+    timed(times, 'html', generate_playlist_html, playlist_dir, work_dir / f"site-{n}")
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(new: dict, old: dict):
+    old_by_n = {r['n']: r for r in old['results']}
+    print(f"Comparison with {old.get('commit')}:")
+    for r in new['results']:
+        if r['n'] not in old_by_n:
+            continue
+        for stage, t in r['times'].items():
+            t_old = old_by_n[r['n']]['times'].get(stage)
+            if t_old:
+                print(f"  n={r['n']:<6} {stage:<20} {t_old:9.3f}s -> {t:9.3f}s ({t / t_old - 1:+.0%})")
+        for key in ('greedy_loss_per_element', 'local_search_loss_per_element', 'anneal_loss_per_element', 'adaptive_loss_per_element'):
+            if key in r and key in old_by_n[r['n']]:
+                print(f"  n={r['n']:<6} {key:<28} {old_by_n[r['n']][key]:.5f} -> {r[key]:.5f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000, 10000])
+    parser.add_argument('--anneal-max', type=int, default=200, help="Largest library size for which simulated annealing is run")
+    parser.add_argument('--local-search-max', type=int, default=1000, help="Largest library size for which the local search is run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=Path('bench_output.json'))
+    parser.add_argument('--compare', type=Path, help="Previous result file to compare against")
+    args = parser.parse_args()
+    report = {'commit': git_commit(), 'seed': args.seed, 'results': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            result = benchmark_size(n, Path(tmp), args.anneal_max, args.local_search_max, args.seed)
+            report['results'].append(result)
+            print(f"n={n}: " + ", ".join(f"{stage} {t:.3f}s" for stage, t in result['times'].items()))
+    args.output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+    print("Wrote", args.output)
+    if args.compare:
+        print_comparison(report, json.loads(args.compare.read_text(encoding='utf-8')))
@@ -0,0 +1,40 @@
+"""
+Cheap change detection for the build entry point.
+Fingerprints only use file names, sizes and modification times, so checking an unchanged library does not read any file contents.
+Keep this module free of heavy imports.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def directory_fingerprint(directory: Path, suffixes: tuple[str, ...] = ('.mp3',), extra: str = "") -> str:
+    """ Hash of the names, sizes and mtimes of all files in `directory` (not recursive) ending with one of `suffixes`. """
+    digest = hashlib.sha256(extra.encode('utf-8'))
+    with os.scandir(directory) as entries:
+        files = sorted((entry.name, entry.stat()) for entry in entries if entry.is_file() and entry.name.endswith(suffixes))
+    for name, stat in files:
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class BuildState:
+    """ Fingerprints of the inputs of the last successful build, stored as JSON. """
+
+    def __init__(self, file: Path):
+        self.file = file
+        self.fingerprints: dict[str, str] = json.loads(file.read_text(encoding='utf-8')) if file.is_file() else {}
+
+    def changed(self, key: str, fingerprint: str) -> bool:
+        return self.fingerprints.get(key) != fingerprint
+
+    def update(self, key: str, fingerprint: str):
+        self.fingerprints[key] = fingerprint
+
+    def save(self, keep: set[str] = None):
+        """ Write the state, dropping all keys not in `keep` if given. """
+        if keep is not None:
+            self.fingerprints = {k: v for k, v in self.fingerprints.items() if k in keep}
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.file.write_text(json.dumps(self.fingerprints, indent=2), encoding='utf-8')
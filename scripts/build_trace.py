@@ -0,0 +1,121 @@
+"""
+Stage timings and counters for the playlist build.
+
+Code reports through the module-level `stage()`, `count()` and `record()` functions, which do nothing unless a `BuildTrace` has been activated.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class BuildTrace:
+    """
+    Records the duration and counters of each build stage.
+
+    Args:
+        profile: Names of stages to run under cProfile.
+        profile_dir: Directory to write `.prof` files of profiled stages to. If `None`, only the top functions are stored in the trace.
+    """
+
+    def __init__(self, profile: tuple[str, ...] = (), profile_dir: Path = None):
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.events: list[dict] = []
+        self.counters: dict[str, int | float] = {}  # counted outside of any stage
+        self._open: list[dict] = []
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, label: str = None):
+        event = {'stage': name, 'label': label, 'start': time.perf_counter() - self._t0, 'duration': None, 'counters': {}, 'records': {}}
+        self._open.append(event)
+        profiler = None
+        if name in self.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield event
+        finally:
+            if profiler:
+                profiler.disable()
+                self._store_profile(event, profiler)
+            event['duration'] = time.perf_counter() - self._t0 - event['start']
+            self._open.remove(event)
+            self.events.append(event)
+
+    def _store_profile(self, event: dict, profiler):
+        import io
+        import pstats
+        if self.profile_dir is not None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            file = self.profile_dir / f"{event['stage']}-{event['label'] or 'all'}.prof".replace(" ", "_")
+            profiler.dump_stats(file)
+            event['profile'] = str(file)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(15)
+        event['profile_top'] = out.getvalue()
+
+    def count(self, name: str, value: int | float = 1):
+        """ Add `value` to a counter of the innermost open stage. Thread-safe. """
+        with self._lock:
+            counters = self._open[-1]['counters'] if self._open else self.counters
+            counters[name] = counters.get(name, 0) + value
+
+    def record(self, name: str, value):
+        """ Append `value` to a series of the innermost open stage, e.g. the acceptance rate per temperature. """
+        with self._lock:
+            if self._open:
+                self._open[-1]['records'].setdefault(name, []).append(value)
+
+    def totals(self) -> dict[str, dict]:
+        """ Total duration and counters per stage name, summed over labels. """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['stage'], {'duration': 0., 'calls': 0, 'counters': {}})
+            total['duration'] += event['duration']
+            total['calls'] += 1
+            for name, value in event['counters'].items():
+                total['counters'][name] = total['counters'].get(name, 0) + value
+        return totals
+
+    def summary(self) -> str:
+        lines = [f"{'Stage':<14} {'Calls':>5} {'Time':>9}  Counters"]
+        for name, total in self.totals().items():
+            counters = ", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in total['counters'].items())
+            lines.append(f"{name:<14} {total['calls']:>5} {total['duration']:>8.2f}s  {counters}")
+        return "\n".join(lines)
+
+    def save(self, file: Path):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(json.dumps({'events': self.events, 'totals': self.totals(), 'counters': self.counters}, indent=2), encoding='utf-8')
+
+
+_active: BuildTrace | None = None
+
+
+def activate(trace: BuildTrace | None):
+    global _active
+    _active = trace
+
+
+@contextmanager
+def stage(name: str, label: str = None):
+    if _active is None:
+        yield None
+    else:
+        with _active.stage(name, label) as event:
+            yield event
+
+
+def count(name: str, value: int | float = 1):
+    if _active is not None:
+        _active.count(name, value)
+
+
+def record(name: str, value):
+    if _active is not None:
+        _active.record(name, value)
@@ -0,0 +1,59 @@
+import os
+import shutil
+import zipfile
+import zlib
+from pathlib import Path
+
+from build_trace import count
+
+CHUNK_SIZE = 1 << 20
+MAX_BUNDLE_SIZE = 95_000_000  # GitHub rejects files over 100 MB
+
+
+def crc32_file(path: Path) -> int:
+    crc = 0
+    with path.open('rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_up_to_date(zip_path: Path, files: list[tuple[Path, str]]) -> bool:
+    """ Whether the archive at `zip_path` holds exactly `files` (source path, name in archive), compared by name, size and CRC-32. """
+    if not zip_path.is_file():
+        return False
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            members = [(info.filename, info.file_size, info.CRC) for info in zf.infolist()]
+    except zipfile.BadZipFile:
+        return False
+    if [(name, size) for name, size, _ in members] != [(name, path.stat().st_size) for path, name in files]:
+        return False  # no need to read the files
+    return all(crc == crc32_file(path) for (_, _, crc), (path, _) in zip(members, files))
+
+
+def write_stored_zip(zip_path: Path, files: list[tuple[Path, str]]) -> bool:
+    """
+    Write an uncompressed ZIP archive of `files` (source path, name in archive) unless an identical one exists.
+    MP3s do not compress, so the files are stored and streamed into the archive in chunks, reading each file once.
+    The archive is written to a temporary file and renamed, so an interrupted build never leaves a truncated download.
+
+    Returns:
+        Whether the archive was written.
+    """
+    if is_up_to_date(zip_path, files):
+        count('files_unchanged')
+        return False
+    tmp = zip_path.with_name(f".{zip_path.name}.part")
+    try:
+        with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for path, name in files:
+                info = zipfile.ZipInfo.from_file(path, name)
+                info.compress_type = zipfile.ZIP_STORED
+                with path.open('rb') as src, zf.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, zip_path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    count('bytes_written', zip_path.stat().st_size)
+    return True
@@ -1,70 +1,171 @@
+import gzip
+import hashlib
 import json
+import sys
 from pathlib import Path
 
-from html_gen.util import escape, slugify
+from html_gen.bundle import MAX_BUNDLE_SIZE, write_stored_zip
+from html_gen.util import escape, slugify, Template, write_if_changed
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def generate_playlist_html(PLAYLISTS_DIR, OUT_DIR):
+
+GENERATOR_VERSION = 1  # bump when the generated output changes for unchanged inputs
+TEMPLATE_DIR = Path(__file__).parent
+HLS_JS = TEMPLATE_DIR / "vendor" / "hls.min.js"  # served next to the player pages instead of loading third-party code from a CDN
+HLS_JS_URL = "https://cdn.jsdelivr.net/npm/hls.js@1.5.20/dist/hls.min.js"  # pinned release that HLS_JS was taken from
+
+DOWNLOAD_BUTTON = """
+<a href="{download_file}" class="download-button" aria-label="Download">
+    <svg class="download-icon" viewBox="0 0 24 24" fill="none" stroke="#FFFFFF" stroke-width="2">
+      <path d="M21 15v4a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2v-4"></path>
+      <polyline points="7 10 12 15 17 10"></polyline>
+      <line x1="12" y1="15" x2="12" y2="3"></line>
+    </svg>
+</a>
+"""
+
+DOWNLOAD_ALL_BUTTON = """<button id="download" class="primary">
+        <svg class="download-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+            <path d="M21 15v4a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2v-4"></path>
+            <polyline points="7 10 12 15 17 10"></polyline>
+            <line x1="12" y1="15" x2="12" y2="3"></line>
+        </svg>
+      </button>"""
+
+DOWNLOAD_ALL_LINK = """<a href="{bundle_file}" download class="download-button" aria-label="Download">
+        <svg class="download-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+            <path d="M21 15v4a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2v-4"></path>
+            <polyline points="7 10 12 15 17 10"></polyline>
+            <line x1="12" y1="15" x2="12" y2="3"></line>
+        </svg>
+      </a>"""
+
+
+def copy_hls_js(out_dir: Path):
+    """ Copy the vendored hls.js into `out_dir`, where the player pages load it for HLS streams in browsers without native support. """
+    if not HLS_JS.is_file():
+        raise FileNotFoundError(f"{HLS_JS} is missing, download it from {HLS_JS_URL} before building with streaming")
+    write_if_changed(out_dir / HLS_JS.name, HLS_JS.read_bytes())
+
+
+def generate_playlist_html(PLAYLISTS_DIR, OUT_DIR, manifest_file: Path = None, release=False, bundle=False):
+    """
+    Render the player and download pages of all playlists.
+
+    If `manifest_file` is given, the input hashes of each playlist (playlist JSON, templates, generator version and, with `bundle`, size and mtime of its MP3s) are stored there and playlists whose inputs are unchanged are skipped.
+    Files whose content would not change are never rewritten.
+
+    In `release` mode, the templates are minified, the playlist data is embedded as compact JSON and precompressed `.gz` (and `.br` if `brotli` is installed) siblings are written next to each page.
+
+    With `bundle`, the hosted MP3s of each playlist are also packed into an uncompressed `audio/<playlist>.zip`, which the download page links to directly.
+    The archive is only rewritten when the names or contents of its tracks change.
+    Without a complete set of MP3s, or if they exceed `MAX_BUNDLE_SIZE`, the download page falls back to zipping the files in the browser.
+    """
     playlist_files = [f for f in PLAYLISTS_DIR.glob("*.json") if not f.name.startswith('_')]
     OUT_DIR.mkdir(parents=True, exist_ok=True)
+    player_template = Template.load(TEMPLATE_DIR / "player_template.html", "playlist_title", "playlist_data", "download_link", minify=release)
+    item_template = Template.load(TEMPLATE_DIR / "download_item_template.html", "name", "download_link", "original_href", minify=release)
+    download_template = Template.load(TEMPLATE_DIR / "download_template.html", "playlist_title", "playlist_title_filename", "playlist_link", "download_all", "files_and_sources", "items", minify=release)
+    json_args = {'separators': (',', ':')} if release else {'indent': 2}
+    compressed_suffixes = ['.gz', '.br'] if release and brotli is not None else ['.gz'] if release else []
+    if release and brotli is None:
+        print("⚠️ brotli is not installed, writing .gz but no .br pages (pip install brotli)")
+    templates_hash = hashlib.sha256(f"{GENERATOR_VERSION}|{compressed_suffixes}|bundle={bundle}".encode())
+    for template in (player_template, download_template, item_template):
+        templates_hash.update(template.source.encode('utf-8'))
+    manifest = {}
+    if manifest_file is not None and manifest_file.is_file():
+        manifest = json.loads(manifest_file.read_text(encoding='utf-8'))
 
     # ---- Generate HTML files ----
     index_entries = []
+    pages = []
     for f in playlist_files:
-        with open(f, "r", encoding="utf-8") as fp:
-            data = json.load(fp)
+        raw = f.read_bytes()
+        input_hash = templates_hash.copy()
+        input_hash.update(raw)
+        data = json.loads(raw.decode('utf-8'))
         for track in data.get("tracks", []):
             if 'full' not in track:
                 track['full'] = track['name']
         playlist_name = data.get("name", f.stem.split("(", 1)[0].strip())
+        filename = slugify(playlist_name) + ".html"
         audio_out_dir = OUT_DIR / "audio" / slugify(playlist_name)
-        audio_out_dir.mkdir(parents=True, exist_ok=True)
         mp3_tracks = [t for t in data.get("tracks", []) if t['url'].lower().endswith('.mp3') and not t['url'].startswith('http')]
+        if bundle:  # the archive depends on the MP3s, which can change without the playlist JSON
+            for t in mp3_tracks:
+                path = audio_out_dir / t['url']
+                stat = path.stat() if path.is_file() else None
+                input_hash.update(f"|{t['url']}:{stat.st_size}:{stat.st_mtime_ns}".encode() if stat else f"|{t['url']}:missing".encode())
+        input_hash = input_hash.hexdigest()
+        index_entries.append((playlist_name, filename, f.name))
+        previous = manifest.get(f.name)
+        if previous and previous['hash'] == input_hash and all((OUT_DIR / (out + suffix)).is_file() for out in previous['outputs'] for suffix in ['', *compressed_suffixes]) and all((OUT_DIR / file).is_file() for file in previous.get('bundles', [])):
+            pages.extend(previous['outputs'])
+            print("Unchanged", filename)
+            continue
+        audio_out_dir.mkdir(parents=True, exist_ok=True)
         supports_download = bool(mp3_tracks)
-        filename = slugify(playlist_name) + ".html"
         download_file = slugify(playlist_name) + "-download.html" if supports_download else None
         for t in mp3_tracks:
             url = t.get("url")
             t["url"] = f"audio/{slugify(playlist_name)}/{url}"
+            if t.get("stream"):
+                t["stream"] = f"audio/{slugify(playlist_name)}/{t['stream']}"
         # --- Write HTML ---
-        index_entries.append((playlist_name, filename, f.name))
-        with (Path(__file__).parent / "player_template.html").open('r', encoding='utf-8') as file:
-            html_text = file.read()
-        html_text = html_text.replace("{playlist_title}", escape(playlist_name))
-        html_text = html_text.replace("{playlist_data}", json.dumps(data, indent=2))
+        html_text = player_template.render(
+            playlist_title=escape(playlist_name),
+            playlist_data=json.dumps(data, **json_args),
+            download_link=DOWNLOAD_BUTTON.format(download_file=download_file) if supports_download else "")
+        written = []
+        bundles = []
+        bundle_file = f"audio/{slugify(playlist_name)}.zip"
         if supports_download:
-            html_text = html_text.replace("{download_link}", f"""
-<a href="{download_file}" class="download-button" aria-label="Download">
-    <svg class="download-icon" viewBox="0 0 24 24" fill="none" stroke="#FFFFFF" stroke-width="2">
-      <path d="M21 15v4a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2v-4"></path>
-      <polyline points="7 10 12 15 17 10"></polyline>
-      <line x1="12" y1="15" x2="12" y2="3"></line>
-    </svg>
-</a>
-""")#f'<a href="{download_file}" class="download-href">Herunterladen</a>')
-            with (Path(__file__).parent / "download_template.html").open('r', encoding='utf-8') as file:
-                download_html = file.read()
-            download_html = download_html.replace("{playlist_title}", escape(playlist_name))
-            download_html = download_html.replace("{playlist_title_filename}", slugify(playlist_name))
-            download_html = download_html.replace("{playlist_link}", filename)
             files_and_sources = [{'url': mp3['url'], 'outputName': f"{i:03d} {slugify(mp3['name'])}.mp3"} for i, mp3 in enumerate(mp3_tracks, 1)]
-            download_html = download_html.replace('{files_and_sources}', json.dumps(files_and_sources, indent=2))
+            bundle_files = [(OUT_DIR / f['url'], f['outputName']) for f in files_and_sources]
+            missing = [path for path, _ in bundle_files if not path.is_file()]
+            if bundle and missing:
+                print(f"⚠️ Not bundling {playlist_name}: {len(missing)} MP3s missing, e.g. {missing[0]}")
+            elif bundle and (size := sum(path.stat().st_size for path, _ in bundle_files)) > MAX_BUNDLE_SIZE:
+                print(f"⚠️ Not bundling {playlist_name}: {size / 1e6:.0f} MB of MP3s exceeds the {MAX_BUNDLE_SIZE / 1e6:.0f} MB limit")
+            elif bundle:
+                if write_stored_zip(OUT_DIR / bundle_file, bundle_files):
+                    written.append(bundle_file)
+                bundles.append(bundle_file)
             items = []
-            with (Path(__file__).parent / "download_item_template.html").open('r', encoding='utf-8') as file:
-                li_html = file.read()
             for mp3 in mp3_tracks:
-                mp3_li = li_html.replace("{name}", mp3['name']).replace("{download_link}", mp3['url'])
-                if mp3['source'] is not None:
-                    mp3_li = mp3_li.replace("{original_href}", f'<a href="{mp3["source"]}" class="original-link" target="_blank">↗</a>')
-                else:
-                    mp3_li = mp3_li.replace("{original_href}", "")
-                items.append(mp3_li)
-            download_html = download_html.replace("{items}", "\n".join(items))
-            (OUT_DIR / download_file).write_text(download_html, encoding="utf-8")
+                original_href = f'<a href="{mp3["source"]}" class="original-link" target="_blank">↗</a>' if mp3['source'] is not None else ""
+                items.append(item_template.render(name=mp3['name'], download_link=mp3['url'], original_href=original_href))
+            download_html = download_template.render(
+                playlist_title=escape(playlist_name),
+                playlist_title_filename=slugify(playlist_name),
+                playlist_link=filename,
+                download_all=DOWNLOAD_ALL_LINK.format(bundle_file=bundle_file) if bundles else DOWNLOAD_ALL_BUTTON,
+                files_and_sources=json.dumps(files_and_sources, **json_args),
+                items="\n".join(items))
+            if write_page(OUT_DIR / download_file, download_html, compressed_suffixes):
+                written.append(download_file)
+        if write_page(OUT_DIR / filename, html_text, compressed_suffixes):
+            written.append(filename)
+        if not bundles:
+            (OUT_DIR / bundle_file).unlink(missing_ok=True)
+        outputs = [filename] + ([download_file] if supports_download else [])
+        pages.extend(outputs)
+        manifest[f.name] = {'hash': input_hash, 'outputs': outputs, 'bundles': bundles}
+        if written:
+            print("Wrote", *written)
         else:
-            html_text = html_text.replace("{download_link}", "")
-        (OUT_DIR / filename).write_text(html_text, encoding="utf-8")
-        print("Wrote", filename, download_file)
+            print("Up to date", filename)
+    if manifest_file is not None:
+        manifest = {name: entry for name, entry in manifest.items() if (PLAYLISTS_DIR / name).is_file()}
+        manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(manifest_file, json.dumps(manifest, indent=2))
+    if release:
+        print_size_report(OUT_DIR, pages, compressed_suffixes)
 
     # ---- Build index.html ----
     # with (Path(__file__).parent / "index_template.html").open('r', encoding='utf-8') as file:
@@ -79,6 +180,28 @@ def generate_playlist_html(PLAYLISTS_DIR, OUT_DIR):
     # print("Wrote", OUT_DIR / "index.html")
 
 
+def write_page(path: Path, text: str, compressed_suffixes: list[str]) -> bool:
+    """ Write a page and its precompressed siblings. Siblings not in `compressed_suffixes` are removed so that hosts never serve outdated versions. Returns whether the page was written. """
+    written = write_if_changed(path, text)
+    data = path.read_bytes() if compressed_suffixes else None
+    for suffix in ('.gz', '.br'):
+        sibling = path.with_name(path.name + suffix)
+        if suffix not in compressed_suffixes:
+            sibling.unlink(missing_ok=True)
+        elif suffix == '.gz':
+            write_if_changed(sibling, gzip.compress(data, compresslevel=9, mtime=0))
+        else:
+            write_if_changed(sibling, brotli.compress(data, quality=11))
+    return written
+
+
+def print_size_report(OUT_DIR: Path, pages: list[str], compressed_suffixes: list[str]):
+    print(f"{'Page':<32} {'HTML':>10}" + "".join(f"{suffix:>10}" for suffix in compressed_suffixes))
+    for page in pages:
+        sizes = [(OUT_DIR / (page + suffix)).stat().st_size for suffix in ['', *compressed_suffixes]]
+        print(f"{page:<32}" + "".join(f" {size / 1024:>7.1f} kB" for size in sizes))
+
+
 if __name__ == '__main__':
     ROOT = Path(__file__).resolve().parent.parent.parent
-    generate_playlist_html(ROOT / "playlists", ROOT / "docs")
+    generate_playlist_html(ROOT / "playlists", ROOT / "docs", ROOT / ".cache" / "html_manifest.json", release="--release" in sys.argv, bundle="--zip" in sys.argv)
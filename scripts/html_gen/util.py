@@ -1,5 +1,8 @@
 import re
 import html
+from pathlib import Path
+
+from build_trace import count
 
 
 def slugify(name: str) -> str:
@@ -10,4 +13,58 @@ def slugify(name: str) -> str:
 
 
 def escape(s: str) -> str:
-    return html.escape(s, quote=True)
\ No newline at end of file
+    return html.escape(s, quote=True)
+
+class Template:
+    """
+    Text template with `{name}` placeholders for the given names.
+    Other braces, e.g. in CSS or JS, are left untouched.
+    The text is split into literal parts once, so rendering is a single join.
+    """
+
+    def __init__(self, text: str, *names: str):
+        pattern = re.compile("|".join(re.escape("{" + name + "}") for name in names))
+        self.source = text
+        self.parts = pattern.split(text)
+        self.keys = [match[1:-1] for match in pattern.findall(text)]
+
+    @staticmethod
+    def load(path: Path, *names: str, minify=False) -> 'Template':
+        with path.open('r', encoding='utf-8') as file:
+            text = file.read()
+        return Template(minify_html(text) if minify else text, *names)
+
+    def render(self, **values: str) -> str:
+        result = [self.parts[0]]
+        for key, part in zip(self.keys, self.parts[1:]):
+            result.append(values[key])
+            result.append(part)
+        return "".join(result)
+
+
+def minify_html(text: str) -> str:
+    """
+    Conservative minification of an HTML page with inline CSS and JS.
+    Removes HTML comments, CSS block comments, full-line JS comments, indentation and blank lines.
+    Line breaks are kept, so JS relying on automatic semicolon insertion keeps working.
+    """
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.DOTALL)
+    text = re.sub(r"<style[^>]*>.*?</style>", lambda m: re.sub(r"/\*.*?\*/", "", m[0], flags=re.DOTALL), text, flags=re.DOTALL)
+    text = re.sub(r"<script[^>]*>.*?</script>", lambda m: re.sub(r"^\s*//.*$", "", m[0], flags=re.MULTILINE), text, flags=re.DOTALL)
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip()) + "\n"
+
+
+def write_if_changed(path: Path, content: str | bytes) -> bool:
+    """ Write `content` to `path` unless the file already has exactly this content. Returns whether the file was written. """
+    if isinstance(content, bytes):
+        if path.is_file() and path.read_bytes() == content:
+            count('files_unchanged')
+            return False
+        path.write_bytes(content)
+    else:
+        if path.is_file() and path.read_text(encoding='utf-8') == content:
+            count('files_unchanged')
+            return False
+        path.write_text(content, encoding='utf-8')
+    count('bytes_written', path.stat().st_size)
+    return True
@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+
+from build_trace import count
+from order_opt.simulated_annealing import compute_weight_matrix, compute_total_loss
+from process_mp3.tracks import Track
+
+
+def local_search(tracks: list[Track], window: int = 12, max_segment: int = 4, cutoff: int = 10, max_rounds: int = 100, time_budget: float = None):
+    """
+    Improve an ordering, e.g. the result of `greedy_fill`, by windowed local search.
+
+    Moves are reversals of segments (2-opt) and relocations of up to `max_segment` tracks (or-opt), both within `window` consecutive positions.
+    Fixed tracks (number != None) never move.
+    Since the loss decays as exp(-distance), pairs further apart than `cutoff` are ignored when scoring a move.
+    All moves starting at one position are scored together on the dense weights between the window and the `cutoff` positions around it,
+    so a sweep takes O(n · window · cutoff) independent of how the tracks are connected.
+    Sweeps apply the best move per start position until no move improves, `max_rounds` is reached or `time_budget` seconds have passed.
+    After the first sweep, only positions near a previous change are re-evaluated.
+
+    Returns:
+        ordering: Reordered tracks.
+        loss: Exact loss of the ordering according to `compute_total_loss`.
+    """
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+    n = len(tracks)
+    weights = compute_weight_matrix(tracks)
+    adjacency = (weights + weights.T).tocsr()
+    indptr, indices, data = adjacency.indptr, adjacency.indices, adjacency.data
+    region_pos = np.full(n, -1)  # position of a track within the current region, -1 outside
+    order = np.arange(n)
+    movable = [t.number is None for t in tracks]
+    distance = np.abs(np.arange(window + 2 * cutoff)[:, None] - np.arange(window + 2 * cutoff)[None, :])
+    pair_decay = np.where((distance > 0) & (distance <= cutoff), np.exp(-distance), 0.)
+    inner_decay = np.triu(pair_decay[:window, :window])  # count pairs within the window once
+    moves_by_length = {}  # length of movable run -> (arrangements, one per row, row 0 = current order; end of the moved part)
+
+    dirty = [True] * n
+    moves = rounds = 0
+    for rounds in range(1, max_rounds + 1):
+        next_dirty = [False] * n
+        improved = False
+        for a in range(n - 1):
+            if not (dirty[a] and movable[a]):
+                continue
+            end = a + 1  # exclusive end of the movable run starting at a, at most `window` long
+            while end < min(n, a + window) and movable[end]:
+                end += 1
+            length = end - a
+            if length < 2:
+                continue
+            if length not in moves_by_length:
+                moves_by_length[length] = candidate_moves(length, max_segment)
+            perms, ends = moves_by_length[length]
+            lo, hi = max(0, a - cutoff), min(n, end + cutoff)
+            inside = order[a:end]
+            region = order[lo:hi]
+            region_pos[region] = np.arange(hi - lo)
+            block = np.zeros((length, hi - lo))  # weights between the window tracks and all tracks of the region
+            for i, u in enumerate(inside.tolist()):
+                cols = region_pos[indices[indptr[u]:indptr[u + 1]]]
+                keep = cols >= 0
+                block[i, cols[keep]] = data[indptr[u]:indptr[u + 1]][keep]
+            region_pos[region] = -1
+            outside_pos = np.r_[0:a - lo, end - lo:hi - lo]
+            # placement[u, k]: loss between window track u at window position k and the tracks around the window, which do not move
+            placement = block[:, outside_pos] @ pair_decay[a - lo:end - lo][:, outside_pos].T
+            inner = block[:, a - lo:end - lo]
+            losses = placement[perms, np.arange(length)].sum(axis=1) + np.einsum('ckl,kl->c', inner[perms[:, :, None], perms[:, None, :]], inner_decay[:length, :length])
+            best = int(np.argmin(losses))
+            if losses[best] - losses[0] < -1e-12:
+                order[a:end] = inside[perms[best]]
+                moves += 1
+                improved = True
+                for k in range(max(0, a - cutoff - window), min(n, a + ends[best] + cutoff)):
+                    next_dirty[k] = True
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+        dirty = next_dirty
+        if not improved or (deadline is not None and time.perf_counter() > deadline):
+            break
+    count('ls_moves', moves)
+    count('ls_rounds', rounds)
+    order = order.tolist()
+    return [tracks[i] for i in order], compute_total_loss(weights, order)
+
+
+def candidate_moves(length: int, max_segment: int) -> tuple[np.ndarray, list[int]]:
+    """
+    All moves within `length` consecutive positions as index arrays, the first being the identity:
+    for each prefix of at least two positions, its reversal and moving up to `max_segment` tracks from its head to its tail or vice versa.
+    Also returns the length of the changed prefix of each move.
+    """
+    perms, ends = [np.arange(length)], [0]
+    for b in range(2, length + 1):
+        seq = np.arange(b)
+        prefix_moves = [seq[::-1]]
+        for segment in range(1, min(max_segment, b - 1) + 1):
+            prefix_moves.append(np.roll(seq, -segment))  # move head segment to the end
+            prefix_moves.append(np.roll(seq, segment))  # move tail segment to the front
+        for move in prefix_moves:
+            perms.append(np.concatenate([move, np.arange(b, length)]))
+            ends.append(b)
+    return np.stack(perms), ends
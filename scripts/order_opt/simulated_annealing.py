@@ -1,7 +1,14 @@
+import os
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
+
 import numpy as np
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix, diags, triu
 
+from build_trace import count, record
 from process_mp3.tracks import Track, check_no_duplicates
 
 LOSS_BY_TAG = {}
@@ -17,7 +24,7 @@ def similarity_loss(t1: Track, t2: Track | None):
     return weight
 
 
-def greedy_fill(ordering: list[Track | None], remaining: list[Track]) -> list[Track]:
+def greedy_fill(ordering: list[Track | None], remaining: list[Track], seed: int = None) -> list[Track]:
     """
     Create an ordering where items with similar tags end up far apart.
     Greedy: start with any item, repeatedly pick the least-similar next item.
@@ -25,30 +32,49 @@ def greedy_fill(ordering: list[Track | None], remaining: list[Track]) -> list[Tr
     check_no_duplicates(ordering)
     check_no_duplicates(remaining)
     remaining = list(remaining)
-    random.shuffle(remaining)
+    random.Random(seed).shuffle(remaining)
+    tracks = [t for t in ordering if t is not None] + remaining
+    index = {t: k for k, t in enumerate(tracks)}
+    similarity = similarity_matrix(tracks)
+    candidates = np.arange(len(tracks) - len(remaining), len(tracks))  # remaining tracks in shuffled order
     for i, t in enumerate(ordering):
         if t is None:
             last = ordering[i-1] if i > 0 else None
             next = ordering[i+1] if i < len(ordering)-1 else None
-            best = min(remaining, key=lambda f: similarity_loss(f, last) + similarity_loss(f, next))
-            ordering[i] = best
-            remaining.remove(best)
-    assert not remaining
+            loss = np.zeros(len(tracks))
+            for neighbour in (last, next):
+                if neighbour is not None:
+                    row = slice(similarity.indptr[index[neighbour]], similarity.indptr[index[neighbour] + 1])
+                    loss[similarity.indices[row]] += similarity.data[row]
+            k = int(np.argmin(loss[candidates]))
+            ordering[i] = tracks[candidates[k]]
+            candidates = np.delete(candidates, k)
+    assert not len(candidates)
     check_no_duplicates(ordering)
     return ordering
 
 
-def compute_weight_matrix(tracks: list[Track]):
-    rows, cols, weights = [], [], []
-    for i, t1 in enumerate(tracks):
-        for j, t2 in enumerate(tracks):
-            if i < j:
-                weight = similarity_loss(t1, t2)
-                if weight:
-                    rows.append(i)
-                    cols.append(j)
-                    weights.append(weight)
-    return coo_matrix((weights, (rows, cols)), shape=(len(tracks), len(tracks)))
+def similarity_matrix(tracks: list[Track]) -> csr_matrix:
+    """
+    Symmetric matrix of `similarity_loss` between all pairs of tracks with zero diagonal.
+    Tags are interned into a vocabulary and the matrix is computed as A·diag(w)·Aᵀ from the sparse track×tag incidence matrix A and the tag losses w.
+    """
+    vocabulary = {}
+    rows, cols = [], []
+    for i, t in enumerate(tracks):
+        for tag in set(t.tags):
+            rows.append(i)
+            cols.append(vocabulary.setdefault(tag, len(vocabulary)))
+    incidence = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(tracks), len(vocabulary)))
+    tag_loss = diags(np.array([LOSS_BY_TAG.get(tag, 1.) for tag in vocabulary]))
+    similarity = (incidence @ tag_loss @ incidence.T).tocsr()
+    similarity = similarity - diags(similarity.diagonal())
+    similarity.eliminate_zeros()
+    return similarity
+
+
+def compute_weight_matrix(tracks: list[Track]) -> coo_matrix:
+    return triu(similarity_matrix(tracks), k=1, format='coo')
 
 
 def compute_total_loss(weights: coo_matrix, ordering: list[int]) -> float:
@@ -60,34 +86,139 @@ def compute_total_loss(weights: coo_matrix, ordering: list[int]) -> float:
     return losses.sum()
 
 
-def simulated_annealing(tracks: list[Track], initial_temp: float = 100.0, cooling_rate: float = 0.995, iterations_per_temp: int = 100, min_temp: float = 1e-3):
-    """ Use simulated annealing of non-fixed (number=None) tracks to find optimal ordering. """
+class SwapDelta:
+    """
+    Incremental evaluation of `compute_total_loss` under pairwise swaps.
+    Keeps the position of every track and a symmetric CSR adjacency so that swapping two positions only touches the edges of the two swapped tracks.
+    """
+
+    def __init__(self, weights: coo_matrix, ordering: list[int]):
+        adjacency = (weights + weights.T).tocsr()
+        self.indptr = adjacency.indptr
+        self.indices = adjacency.indices
+        self.data = adjacency.data
+        self.ordering = ordering
+        self.pos = np.empty(len(ordering), dtype=int)
+        self.pos[ordering] = np.arange(len(ordering))
+        self.decay = np.exp(-np.arange(len(ordering)))  # exp(-distance) lookup
+
+    def delta(self, i: int, j: int) -> float:
+        """Change in total loss when swapping the tracks at positions `i` and `j`."""
+        a, b = self.ordering[i], self.ordering[j]
+        return self._move_delta(a, i, j, b) + self._move_delta(b, j, i, a)
+
+    def _move_delta(self, track: int, old_pos: int, new_pos: int, partner: int) -> float:
+        lo, hi = self.indptr[track], self.indptr[track + 1]
+        neighbours = self.indices[lo:hi]
+        keep = neighbours != partner  # distance to the swap partner is unchanged
+        other_pos = self.pos[neighbours[keep]]
+        w = self.data[lo:hi][keep]
+        return float(w @ (self.decay[np.abs(new_pos - other_pos)] - self.decay[np.abs(old_pos - other_pos)]))
+
+    def swap(self, i: int, j: int):
+        """Apply the swap of positions `i` and `j` in place."""
+        a, b = self.ordering[i], self.ordering[j]
+        self.ordering[i], self.ordering[j] = b, a
+        self.pos[a], self.pos[b] = j, i
+
+
+def simulated_annealing(tracks: list[Track], initial_temp: float = 100.0, cooling_rate: float = 0.995, iterations_per_temp: int = 100, min_temp: float = 1e-3, chains: int = 1, seed: int = None, progress: Callable[[float, float, float], None] = None,
+                        adaptive=False, target_acceptance: float = 0.1, frozen_acceptance: float = 0.01, frozen_steps: int = 100, patience: int = None, time_budget: float = None):
+    """
+    Use simulated annealing of non-fixed (number=None) tracks to find optimal ordering.
+
+    With `chains > 1`, independent chains are run on a process pool and the best ordering is returned.
+    The result only depends on `seed` and `chains`, not on the number of available cores.
+
+    progress: Called after each temperature step with the temperature, the best loss per element and the acceptance rate of that step.
+        With multiple chains, only the first chain reports progress.
+    adaptive: Calibrate the initial temperature from sampled move deltas instead of using `initial_temp`,
+        cool faster while the acceptance rate is above `target_acceptance`, where moves are mostly a random walk,
+        and slower while it is between `frozen_acceptance` and `target_acceptance`, where most of the improvement happens.
+        Below `frozen_acceptance`, the chain is nearly frozen: it cools at the normal rate and stops after `frozen_steps` such steps in a row.
+    patience: Stop after this many temperature steps without improving the best loss.
+    time_budget: Stop each chain after this many seconds.
+    """
     weights = compute_weight_matrix(tracks)
-    current = list(range(len(tracks)))
-    current_loss = compute_total_loss(weights, current)
     variable_indices = [i for i, t in enumerate(tracks) if t.number is None]
     if len(variable_indices) <= 1:
-        return tracks, current_loss
+        return tracks, compute_total_loss(weights, list(range(len(tracks))))
+    schedule = dict(initial_temp=initial_temp, cooling_rate=cooling_rate, iterations_per_temp=iterations_per_temp, min_temp=min_temp,
+                    adaptive=adaptive, target_acceptance=target_acceptance, frozen_acceptance=frozen_acceptance, frozen_steps=frozen_steps, patience=patience, time_budget=time_budget)
+    chain = partial(anneal_chain, weights, variable_indices, **schedule)
+    if chains == 1:
+        results = [chain(seed, progress=progress)]
+    else:
+        chain_seeds = random.Random(seed).sample(range(2**32), chains)
+        with ProcessPoolExecutor(max_workers=min(chains - 1, os.cpu_count())) as pool:
+            others = pool.map(chain, chain_seeds[1:])
+            results = [chain(chain_seeds[0], progress=progress), *others]
+    for _, _, stats in results:
+        count('sa_accepted', stats['accepted'])
+        count('sa_rejected', stats['rejected'])
+        record('sa_acceptance_rate', stats['acceptance_rates'])
+    best, best_loss, _ = min(results, key=lambda r: r[1])
+    # Convert indices back to element names
+    best_ordering = [tracks[i] for i in best]
+    return best_ordering, best_loss
+
+
+def anneal_chain(weights: coo_matrix, variable_indices: list[int], seed: int | None, initial_temp: float, cooling_rate: float, iterations_per_temp: int, min_temp: float, progress: Callable[[float, float, float], None] = None,
+                 adaptive=False, target_acceptance: float = 0.1, frozen_acceptance: float = 0.01, frozen_steps: int = 100, patience: int = None, time_budget: float = None) -> tuple[list[int], float, dict]:
+    """ Run a single annealing chain starting from the identity ordering. See `simulated_annealing` for the schedule arguments. Returns the best index ordering, its loss and move statistics. """
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+    rng = random.Random(seed)
+    current = list(range(weights.shape[0]))
+    current_loss = compute_total_loss(weights, current)
+    swaps = SwapDelta(weights, current)
     best = current.copy()
     best_loss = current_loss
-    temp = initial_temp
+    stats = {'accepted': 0, 'rejected': 0, 'acceptance_rates': []}
+    temp = calibrate_temperature(swaps, variable_indices, rng, min_temp) if adaptive else initial_temp
+    steps_without_improvement = frozen = 0
     while temp > min_temp:
-        print(temp, best_loss / len(tracks))
+        accepted = 0
+        previous_best = best_loss
         for _ in range(iterations_per_temp):
-            # Generate neighbor by swapping two random elements
-            new = current.copy()
-            i, j = random.sample(variable_indices, 2)
-            new[i], new[j] = new[j], new[i]
-            new_loss = compute_total_loss(weights, new)
-            delta_loss = new_loss - current_loss
+            # Evaluate swapping two random elements
+            i, j = rng.sample(variable_indices, 2)
+            delta_loss = swaps.delta(i, j)
             # Accept or reject move
-            if delta_loss < 0 or random.random() < np.exp(-delta_loss / temp):
-                current = new
-                current_loss = new_loss
+            if delta_loss < 0 or rng.random() < np.exp(-delta_loss / temp):
+                swaps.swap(i, j)
+                accepted += 1
+                current_loss += delta_loss
                 if current_loss < best_loss:
                     best = current.copy()
                     best_loss = current_loss
-        temp *= cooling_rate
-    # Convert indices back to element names
-    best_ordering = [tracks[i] for i in best]
-    return best_ordering, best_loss
+        stats['accepted'] += accepted
+        stats['rejected'] += iterations_per_temp - accepted
+        stats['acceptance_rates'].append(accepted / iterations_per_temp)
+        if progress is not None:
+            progress(temp, best_loss / len(current), accepted / iterations_per_temp)
+        # best_loss is a running sum, so near-neutral moves lower it by rounding noise that must not reset the patience counter
+        steps_without_improvement = 0 if best_loss < previous_best - 1e-9 * abs(previous_best) else steps_without_improvement + 1
+        if patience is not None and steps_without_improvement >= patience:
+            break
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        frozen = frozen + 1 if accepted / iterations_per_temp < frozen_acceptance else 0
+        if adaptive and frozen >= frozen_steps:
+            break
+        if adaptive and accepted / iterations_per_temp > target_acceptance:
+            temp *= cooling_rate ** 3
+        elif adaptive and frozen_acceptance <= accepted / iterations_per_temp < target_acceptance:
+            temp *= cooling_rate ** 0.5
+        else:
+            temp *= cooling_rate
+    best_loss = compute_total_loss(weights, best)  # discard accumulated rounding errors
+    return best, best_loss, stats
+
+
+def calibrate_temperature(swaps: SwapDelta, variable_indices: list[int], rng: random.Random, min_temp: float, initial_acceptance=0.8, samples=200) -> float:
+    """ Initial temperature at which an average uphill move is accepted with probability `initial_acceptance`, estimated from random swaps that are not applied. """
+    deltas = [swaps.delta(*rng.sample(variable_indices, 2)) for _ in range(samples)]
+    uphill = [d for d in deltas if d > 0]
+    if not uphill:
+        return min_temp
+    return float(-np.mean(uphill) / np.log(initial_acceptance))
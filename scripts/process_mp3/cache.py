@@ -0,0 +1,53 @@
+import json
+import os
+from pathlib import Path
+
+from build_trace import count
+
+
+class FileCache:
+    """
+    Persistent cache of values derived from source files, stored as JSON lines.
+    Entries are keyed by (path, size, mtime_ns) so that modified files are treated as misses.
+    Entries of files that no longer exist are evicted on `save()`.
+    """
+
+    def __init__(self, file: Path):
+        self.file = file
+        self.entries: dict[str, dict] = {}
+        self.hits = self.misses = 0
+        if file.is_file():
+            with file.open('r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['path']] = entry
+
+    @staticmethod
+    def key(path: Path) -> tuple[str, int, int]:
+        stat = path.stat()
+        return str(path.resolve()), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path: Path) -> dict | None:
+        key, size, mtime_ns = self.key(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+            self.hits += 1
+            count(f"{self.file.stem}_cache_hits")
+            return entry['value']
+        self.misses += 1
+        count(f"{self.file.stem}_cache_misses")
+        return None
+
+    def put(self, path: Path, value: dict):
+        key, size, mtime_ns = self.key(path)
+        self.entries[key] = {'path': key, 'size': size, 'mtime_ns': mtime_ns, 'value': value}
+
+    def save(self):
+        self.entries = {key: entry for key, entry in self.entries.items() if os.path.isfile(key)}
+        self.file.parent.mkdir(exist_ok=True, parents=True)
+        tmp = self.file.with_suffix(self.file.suffix + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.file)
@@ -1,42 +1,176 @@
-from pathlib import Path
+import hashlib
+import os
+import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
+from pathlib import Path
 
+from build_trace import count
+from .cache import FileCache
 from .tracks import Track
 
 
-def compress_mp3_vbr(track: Track, output_path: Path, vbr_quality=7, overwrite=True):
+def audio_hash(path: Path) -> str:
+    """ SHA-256 of the audio data of an MP3, skipping ID3v2 and ID3v1 tags so that tag edits do not change the hash. """
+    size = path.stat().st_size
+    with path.open('rb') as f:
+        start = 0
+        header = f.read(10)
+        if header[:3] == b'ID3':
+            start = 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+            if header[5] & 0x10:  # footer present
+                start += 10
+        end = size
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b'TAG':
+                end = size - 128
+        digest = hashlib.sha256()
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+class EncodeStore:
+    """
+    Content-addressed store of encoded MP3s, keyed by a hash of the source audio and the encoder settings.
+    Renumbered or re-tagged tracks are copied from the store instead of being re-encoded.
+    """
+
+    def __init__(self, directory: Path, hash_cache: FileCache = None):
+        self.directory = directory
+        self.hash_cache = hash_cache
+
+    @cached_property
+    def encoder_version(self) -> str:
+        result = subprocess.run(["ffmpeg", "-version"], check=True, capture_output=True, text=True)
+        return result.stdout.split("\n", 1)[0]
+
+    def source_hash(self, path: Path) -> str:
+        cached = self.hash_cache.get(path) if self.hash_cache is not None else None
+        if cached is not None:
+            return cached['sha256']
+        digest = audio_hash(path)
+        if self.hash_cache is not None:
+            self.hash_cache.put(path, {'sha256': digest})
+        return digest
+
+    def file(self, source: Path, vbr_quality: int, gain_db: float = 0.) -> Path:
+        """ Location of the encode of `source` with the given settings. The file may not exist yet. """
+        settings = f"libmp3lame|q{vbr_quality}" + (f"|gain{gain_db:+.1f}dB" if gain_db else "")
+        key = hashlib.sha256(f"{self.source_hash(source)}|{settings}|{self.encoder_version}".encode()).hexdigest()
+        return self.directory / key[:2] / f"{key}.mp3"
+
+    def save(self):
+        if self.hash_cache is not None:
+            self.hash_cache.save()
+
+
+def compress_mp3_vbr(track: Track, output_path: Path, vbr_quality=7, overwrite=True, store: EncodeStore = None, gain_db: float = 0.) -> bool:
     """
     Compress MP3 to lower VBR bitrate using FFmpeg.
+    The output is written to a temporary file and renamed, so an interrupted run never leaves a truncated MP3.
 
     vbr_quality: LAME VBR quality level (0 = highest quality, 9 = lowest bitrate).
+    store: If given, the encode is looked up in / added to this store and copied to `output_path`.
+    gain_db: Volume change applied during encoding, e.g. from `loudness.normalization_gain()`.
+
+    Returns:
+        `False` if the file already existed and was not overwritten, `True` otherwise.
     """
     if not overwrite and output_path.is_file():
-        print(f"Already exists: {output_path}")
-        return
+        return False
     output_path.parent.mkdir(exist_ok=True, parents=True)
+    tmp = output_path.with_name(f".{output_path.name}.part")
+    try:
+        if store is not None:
+            encoded = store.file(track.file_path, vbr_quality, gain_db)
+            count('encode_store_hits' if encoded.is_file() else 'encode_store_misses')
+            if not encoded.is_file():
+                encoded.parent.mkdir(exist_ok=True, parents=True)
+                encoded_tmp = encoded.with_name(f".{encoded.name}.{threading.get_ident()}.part")
+                try:
+                    run_ffmpeg(track.file_path, encoded_tmp, vbr_quality, gain_db)
+                    os.replace(encoded_tmp, encoded)
+                finally:
+                    encoded_tmp.unlink(missing_ok=True)
+            # copy rather than hardlink: apply_id3 rewrites the file in place
+            shutil.copyfile(encoded, tmp)
+        else:
+            run_ffmpeg(track.file_path, tmp, vbr_quality, gain_db)
+        track.apply_id3(str(tmp), track.number, track.playlist_name)
+        os.replace(tmp, output_path)
+        count('bytes_written', output_path.stat().st_size)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return True
+
+
+def run_ffmpeg(source: Path, output_path: Path, vbr_quality: int, gain_db: float = 0.):
     command = [
         "ffmpeg",
         "-y",  # overwrite output without asking
-        "-i", str(track.file_path),
+        "-i", str(source),
+        *(["-af", f"volume={gain_db:.1f}dB"] if gain_db else []),
         "-codec:a", "libmp3lame",
         "-qscale:a", str(vbr_quality),
+        "-f", "mp3",  # output may not have an .mp3 extension
         str(output_path)
     ]
-    result = subprocess.run(command, check=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-    track.apply_id3(str(output_path), track.number, track.playlist_name)
-    if result.returncode == 0:
-        print(f"✅ Wrote compressed {output_path}")
-    else:
-        raise RuntimeError(f"Failed to write {output_path}")
-
-
-def compress_mp3_vbr_parallel(tracks: list[Track], outputs: list[Path], vbr_quality=7, overwrite=True):
-    # for track, path_out in zip(tracks, outputs):
-    #     compress_mp3_vbr(track, path_out, vbr_quality, overwrite)
-    from concurrent.futures import ProcessPoolExecutor
-    with ProcessPoolExecutor(max_workers=12) as pool:
-        for track, path_out in zip(tracks, outputs):
-            pool.submit(compress_mp3_vbr, track, path_out, vbr_quality, overwrite)
+    count('ffmpeg_invocations')
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"
+        raise RuntimeError(f"ffmpeg failed on {source}: {message}")
+
+
+def compress_mp3_vbr_parallel(tracks: list[Track], outputs: list[Path], vbr_quality=7, overwrite=True, store: EncodeStore = None, gains: list[float] = None, max_workers: int = None, retries: int = 1, label: str = ""):
+    """
+    Run `compress_mp3_vbr` for all tracks on a thread pool sized to the number of CPUs.
+    `gains` optionally holds the volume change in dB for each track.
+    The threads only wait on their ffmpeg subprocesses, so no Python process has to be spawned per job.
+    Failed jobs are retried `retries` times and progress with ETA is printed as jobs finish.
+
+    Raises:
+        RuntimeError: listing all failed outputs, once every job has finished.
+    """
+    jobs = list(zip(tracks, outputs, gains or [0.] * len(tracks)))
+    start = time.perf_counter()
+    failures = []
+
+    def run_job(track: Track, path_out: Path, gain_db: float):
+        for attempt in range(retries + 1):
+            try:
+                return compress_mp3_vbr(track, path_out, vbr_quality, overwrite, store, gain_db)
+            except Exception as err:
+                if attempt == retries:
+                    raise
+                print(f"⚠️ Retrying {path_out.name}: {err}")
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        futures = {pool.submit(run_job, *job): job[1] for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            path_out = futures[future]
+            eta = (time.perf_counter() - start) / done * (len(jobs) - done)
+            try:
+                status = "✅ Wrote compressed" if future.result() else "Already exists:"
+            except Exception as err:
+                failures.append((path_out, err))
+                status = f"❌ Failed ({err})"
+            print(f"{label}[{done}/{len(jobs)}, ETA {eta:.0f}s] {status} {path_out}")
+    if store is not None:
+        store.save()
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(jobs)} encodes failed:\n" + "\n".join(f"  {path}: {err}" for path, err in failures))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+"""
+Compact audio fingerprints for finding the same recording under different tags or encodings.
+
+Each fingerprint is a sequence of 32-bit sub-fingerprints, one per 93 ms of audio, whose bits are the signs of
+band energy differences across frequency and time (Haitsma & Kalker, "A Highly Robust Audio Fingerprinting System").
+Re-encodes, volume changes and different leading silence change only few bits, unrelated recordings differ in about half.
+The least reliable bits of each sub-fingerprint are stored alongside it, so that queries can also look up variants with those bits flipped.
+"""
+import itertools
+import base64
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from build_trace import count
+from .cache import FileCache
+
+SAMPLE_RATE = 5512
+FRAME = 2048
+HOP = 512
+BANDS = 33  # 32 bits from the differences of adjacent bands
+MIN_FREQ, MAX_FREQ = 300., 2000.
+DURATION = 120.  # only the start of each file is fingerprinted
+MAX_BIT_ERROR_RATE = 0.35
+MIN_OVERLAP = 64  # sub-fingerprints, about 6 s
+WEAK_BITS = 8  # least reliable bits per sub-fingerprint
+MAX_FLIPS = 2  # of the weak bits, per looked-up variant
+VERSION = 3  # bump when fingerprints of the same audio change, invalidating cached ones
+
+
+def fingerprint_pcm(samples: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Fingerprint mono audio sampled at `SAMPLE_RATE`.
+
+    Returns:
+        fingerprint: Sub-fingerprints (uint32).
+        weak: For each sub-fingerprint, a mask of its `WEAK_BITS` least reliable bits, i.e. those whose energy difference is closest to zero.
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if len(samples) < FRAME + 3 * HOP:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP] * np.hanning(FRAME).astype(np.float32)
+    spectrum = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+    edges = np.round(np.geomspace(MIN_FREQ, MAX_FREQ, BANDS + 1) * FRAME / SAMPLE_RATE).astype(int)
+    energy = np.add.reduceat(spectrum, edges, axis=1)[:, :BANDS]  # the last slice, from edges[-1] to Nyquist, is dropped
+    diff = energy[:, :-1] - energy[:, 1:]
+    margin = diff[2:] - diff[:-2]  # comparing frames two hops apart is more robust than adjacent ones
+    fingerprint = np.packbits(margin > 0, axis=1, bitorder='little').view('<u4')[:, 0].astype(np.uint32)
+    weakest = np.argpartition(np.abs(margin), WEAK_BITS, axis=1)[:, :WEAK_BITS]
+    weak = np.bitwise_or.reduce(np.left_shift(np.uint32(1), weakest.astype(np.uint32)), axis=1)
+    return fingerprint, weak
+
+
+def audio_fingerprint(path: Path, duration: float = DURATION) -> tuple[np.ndarray, np.ndarray]:
+    """ Decode the first `duration` seconds of an audio file with FFmpeg and fingerprint them like `fingerprint_pcm`. """
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-v", "error", "-t", str(duration), "-i", str(path), "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"]
+    count('ffmpeg_invocations')
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Decoding failed for {path}: {result.stderr.decode(errors='replace').strip()}")
+    pcm = np.frombuffer(result.stdout[:len(result.stdout) // 2 * 2], dtype='<i2')
+    return fingerprint_pcm(pcm)
+
+
+def encode_array(values: np.ndarray) -> str:
+    return base64.b64encode(values.astype('<u4').tobytes()).decode('ascii')
+
+
+def decode_array(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype='<u4').astype(np.uint32)
+
+
+def fingerprint_parallel(paths: list[Path], cache: FileCache = None, max_workers: int = None) -> list[tuple[np.ndarray, np.ndarray]]:
+    """ Run `audio_fingerprint` for all files that are not in `cache` on a thread pool and add the results to the cache. """
+    cached = [cache.get(path) if cache is not None else None for path in paths]
+    results: list[tuple | None] = [(decode_array(c['fingerprint']), decode_array(c['weak'])) if c is not None and c.get('version') == VERSION else None for c in cached]
+    misses = [i for i, r in enumerate(results) if r is None]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for i, (fingerprint, weak) in zip(misses, pool.map(lambda i: audio_fingerprint(paths[i]), misses)):
+            results[i] = fingerprint, weak
+            if cache is not None:
+                cache.put(paths[i], {'fingerprint': encode_array(fingerprint), 'weak': encode_array(weak), 'version': VERSION})
+    return results
+
+
+def flipped_variants(fingerprint: np.ndarray, weak: np.ndarray, max_flips: int = MAX_FLIPS) -> np.ndarray:
+    """ Each sub-fingerprint (rows) with every combination of up to `max_flips` of its weak bits flipped (columns), starting with the unchanged value. """
+    bit_index = np.nonzero((weak[:, None] >> np.arange(32, dtype=np.uint32)) & 1)[1].reshape(len(weak), -1)
+    bit_values = np.left_shift(np.uint32(1), bit_index.astype(np.uint32))
+    flips = [np.zeros(len(weak), dtype=np.uint32)]
+    for n in range(1, max_flips + 1):
+        for combination in itertools.combinations(range(bit_index.shape[1]), n):
+            flips.append(np.bitwise_or.reduce(bit_values[:, combination], axis=1))
+    return fingerprint[:, None] ^ np.stack(flips, axis=1)
+
+
+def bit_error_rate(a: np.ndarray, b: np.ndarray, offset: int) -> tuple[float, int]:
+    """ Fraction of differing bits between `a[offset + i]` and `b[i]` over their overlap, and the overlap length. """
+    start, end = max(0, -offset), min(len(b), len(a) - offset)
+    if end <= start:
+        return 1., 0
+    xor = np.bitwise_xor(a[start + offset:end + offset], b[start:end])
+    errors = int(np.unpackbits(xor.view(np.uint8)).sum())
+    return errors / (32 * (end - start)), end - start
+
+
+class FingerprintIndex:
+    """
+    Inverted index from sub-fingerprint values to (item, position) for near-duplicate queries.
+    Candidate alignments are found from sub-fingerprints that match exactly or after flipping some of their weak bits (see `flipped_variants`),
+    and are then verified by the bit error rate of the whole overlap.
+    """
+
+    def __init__(self, max_bit_error_rate=MAX_BIT_ERROR_RATE, min_overlap=MIN_OVERLAP):
+        self.max_bit_error_rate = max_bit_error_rate
+        self.min_overlap = min_overlap
+        self.items: list = []
+        self.fingerprints: list[np.ndarray] = []
+        self.postings: dict[int, list[tuple[int, int]]] = {}
+        self.maybe_present = np.zeros(1 << 24, dtype=bool)  # by the top 24 bits of indexed values, to skip most lookups
+
+    def add(self, item, fingerprint: np.ndarray):
+        idx = len(self.items)
+        self.items.append(item)
+        self.fingerprints.append(fingerprint)
+        self.maybe_present[fingerprint >> 8] = True
+        for pos, value in enumerate(fingerprint.tolist()):
+            if value:  # all-zero sub-fingerprints come from silence and would match anything
+                self.postings.setdefault(value, []).append((idx, pos))
+
+    def query(self, fingerprint: np.ndarray, weak: np.ndarray, candidates: int = 5) -> list[tuple[object, float]]:
+        """ Items whose fingerprint matches `fingerprint` at some alignment, with their bit error rate, best first. `weak` holds the masks returned by `fingerprint_pcm`. """
+        variants = flipped_variants(fingerprint, weak)
+        positions, columns = np.nonzero(self.maybe_present[variants >> 8])
+        votes: dict[tuple[int, int], int] = {}
+        for pos, value in zip(positions.tolist(), variants[positions, columns].tolist()):
+            for idx, other_pos in self.postings.get(value, ()):
+                key = (idx, other_pos - pos)
+                votes[key] = votes.get(key, 0) + 1
+        best: dict[int, float] = {}
+        for (idx, offset), n in sorted(votes.items(), key=lambda kv: -kv[1])[:candidates]:
+            if n < 2 or idx in best:
+                continue
+            ber, overlap = bit_error_rate(self.fingerprints[idx], fingerprint, offset)
+            if overlap >= min(self.min_overlap, len(fingerprint), len(self.fingerprints[idx])) and ber <= self.max_bit_error_rate:
+                best[idx] = ber
+        return sorted(((self.items[idx], ber) for idx, ber in best.items()), key=lambda r: r[1])
+
+
+def find_duplicates(paths: list[Path], fingerprints: list[tuple[np.ndarray, np.ndarray]], **index_kwargs) -> dict[Path, tuple[Path, float]]:
+    """
+    Find files that contain the same audio as an earlier file in `paths`, given their fingerprints and weak-bit masks from `fingerprint_parallel`.
+
+    Returns:
+        Dict mapping each duplicate to the earliest matching file and the bit error rate of the match.
+    """
+    index = FingerprintIndex(**index_kwargs)
+    duplicates = {}
+    for path, (fingerprint, weak) in zip(paths, fingerprints):
+        if len(fingerprint) == 0:
+            continue
+        matches = index.query(fingerprint, weak)
+        if matches:
+            duplicates[path] = matches[0]
+            count('duplicates_found')
+        else:
+            index.add(path, fingerprint)
+    return duplicates
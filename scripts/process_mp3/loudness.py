@@ -0,0 +1,54 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from build_trace import count
+from .cache import FileCache
+
+TARGET_LUFS = -16.
+MAX_TRUE_PEAK = -1.
+MAX_GAIN = 20.
+
+
+def measure_loudness(path: Path) -> dict:
+    """
+    Measure the EBU R128 loudness of an audio file with FFmpeg's `ebur128` filter.
+    This decodes the whole file.
+
+    Returns:
+        Dict with integrated loudness `I` (LUFS), loudness range `LRA` (LU) and true peak `peak` (dBTP).
+    """
+    command = ["ffmpeg", "-hide_banner", "-nostats", "-i", str(path), "-filter_complex", "ebur128=peak=true", "-f", "null", "-"]
+    count('ffmpeg_invocations')
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    if result.returncode != 0 or "Summary:" not in result.stderr:
+        raise RuntimeError(f"Loudness measurement failed for {path}")
+    summary = result.stderr[result.stderr.rindex("Summary:"):]
+    return {
+        'I': float(re.search(r"I:\s+(\S+) LUFS", summary)[1]),
+        'LRA': float(re.search(r"LRA:\s+(\S+) LU", summary)[1]),
+        'peak': float(re.search(r"Peak:\s+(\S+) dBFS", summary)[1]),
+    }
+
+
+def measure_loudness_parallel(paths: list[Path], cache: FileCache = None, max_workers: int = None) -> list[dict]:
+    """ Run `measure_loudness` for all files that are not in `cache` on a thread pool and add the results to the cache. """
+    results: list[dict | None] = [cache.get(path) if cache is not None else None for path in paths]
+    misses = [i for i, r in enumerate(results) if r is None]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for i, loudness in zip(misses, pool.map(lambda i: measure_loudness(paths[i]), misses)):
+            results[i] = loudness
+            if cache is not None:
+                cache.put(paths[i], loudness)
+    return results
+
+
+def normalization_gain(loudness: dict, target_lufs=TARGET_LUFS, max_true_peak=MAX_TRUE_PEAK) -> float:
+    """
+    Gain in dB that brings a track to `target_lufs` without pushing its true peak above `max_true_peak`.
+    The result is rounded to 0.1 dB so that encodes of the same source stay cacheable.
+    """
+    gain = min(target_lufs - loudness['I'], max_true_peak - loudness['peak'], MAX_GAIN)
+    return round(gain, 1) + 0.  # avoid -0.0
@@ -0,0 +1,71 @@
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from build_trace import count
+
+SEGMENT_SECONDS = 6
+
+
+def segment_mp3(mp3: Path, out_dir: Path, segment_seconds: float = SEGMENT_SECONDS) -> Path:
+    """
+    Split an encoded MP3 into HLS segments of about `segment_seconds` without re-encoding.
+    The segments and the `index.m3u8` manifest are written to a temporary directory that is renamed to `out_dir` once complete.
+
+    Returns:
+        Path of the manifest.
+    """
+    tmp = out_dir.with_name(f".{out_dir.name}.part")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        "-i", str(mp3),
+        "-map", "0:a",  # drop cover art
+        "-codec", "copy",
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "vod",
+        "-hls_segment_filename", str(tmp / "%03d.ts"),
+        str(tmp / "index.m3u8")
+    ]
+    count('ffmpeg_invocations')
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+        if result.returncode != 0:
+            message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"
+            raise RuntimeError(f"Segmenting failed for {mp3}: {message}")
+        os.replace(tmp, out_dir)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return out_dir / "index.m3u8"
+
+
+def segment_parallel(mp3s: list[Path], keys: list[str], stream_dir: Path, segment_seconds: float = SEGMENT_SECONDS, max_workers: int = None) -> list[Path]:
+    """
+    Run `segment_mp3` for all files on a thread pool.
+    The segments of each file are stored in `stream_dir` under its key, e.g. the `EncodeStore` key of its encode,
+    so renumbered or re-tagged tracks reuse their existing segments without reading the MP3s.
+    Directories in `stream_dir` that no longer belong to any of `keys` are removed.
+
+    Returns:
+        Manifest path of each file.
+    """
+    out_dirs = [stream_dir / key for key in keys]
+
+    def run_job(mp3: Path, out_dir: Path) -> Path:
+        manifest = out_dir / "index.m3u8"
+        if manifest.is_file():
+            count('segments_reused')
+            return manifest
+        count('segments_created')
+        return segment_mp3(mp3, out_dir, segment_seconds)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        manifests = list(pool.map(run_job, mp3s, out_dirs))
+    if stream_dir.is_dir():
+        for stale in set(stream_dir.iterdir()) - set(out_dirs):
+            shutil.rmtree(stale, ignore_errors=True)
+    return manifests
@@ -1,10 +1,14 @@
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import cached_property
 from pathlib import Path
 from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK, TIT3, TPE2, TCON, COMM
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
+from .cache import FileCache
+
 
 def slugify(name: str) -> str:
     name = name.lower()
@@ -31,7 +35,7 @@ class Track:
         tags = ID3()
         tags.add(TIT2(encoding=3, text=self.title))
         tags.add(TIT3(encoding=3, text=self.subtitle))
-        tags.add(TPE1(encoding=3, text=", ".join(list({self.album_artist, self.artist}))))
+        tags.add(TPE1(encoding=3, text=", ".join(dict.fromkeys([self.album_artist, self.artist]))))  # ordered, unlike a set
         tags.add(TPE2(encoding=3, text="KlangFarben"))  # Album artist
         tags.add(TALB(encoding=3, text=playlist_name.split('(', 1)[0].strip()))
         if self.genre:
@@ -56,7 +60,7 @@ class Track:
             artist = artist.split(' ')[-1]
         return f"{title} • {self.album}" if self.album else f"{title} • {artist}"
 
-    @property
+    @cached_property
     def long_name(self):
         title = self.title.split('(', 1)[0].strip()
         if self.subtitle:
@@ -64,7 +68,11 @@ class Track:
         return f"{title} • {self.album} • {self.artist}" if self.album else f"{title} • {self.artist}"
 
     def get_output_filename(self, number: int):
-        return f"{number:03d} {slugify(self.artist)} - {slugify(self.title)}.mp3"
+        return f"{number:03d} {self.output_slug}.mp3"
+
+    @cached_property
+    def output_slug(self):
+        return f"{slugify(self.artist)} - {slugify(self.title)}"
 
     @property
     def is_hosted_externally(self):
@@ -96,16 +104,37 @@ class Track:
         return float(time_str) if time_str else None
 
 
+class TrackIndex:
+    """ Lookup of tracks by `long_name` and output file name, built once for a whole library. """
+
+    def __init__(self, tracks: list[Track]):
+        self.by_name: dict[str, list[Track]] = {}
+        self.by_name_and_slug: dict[tuple[str, str], list[Track]] = {}
+        for t in tracks:
+            if t is not None:
+                self.by_name.setdefault(t.long_name, []).append(t)
+                self.by_name_and_slug.setdefault((t.long_name, t.output_slug), []).append(t)
+
+    def search(self, long_name: str, url: str, number: int) -> Track | None:
+        matches = self.by_name.get(long_name, [])
+        if not matches:
+            return None
+        elif len(matches) == 1:
+            return matches[0]
+        else:  # multiple matches, disambiguate by output file name
+            prefix, suffix = f"{number:03d} ", ".mp3"
+            if not (url.startswith(prefix) and url.endswith(suffix)):
+                return None
+            matches2 = self.by_name_and_slug.get((long_name, url[len(prefix):-len(suffix)]), [])
+            assert len(matches2) <= 1
+            return matches2[0] if matches2 else None
+
+    def duplicates(self) -> dict[str, list[Track]]:
+        return {name: matches for name, matches in self.by_name.items() if len(matches) > 1}
+
+
 def search_track(long_name: str, url: str, number: int, tracks: list[Track]):
-    matches = [t for t in tracks if t.long_name == long_name]
-    if not matches:
-         return None
-    elif len(matches) == 1:
-        return matches[0]
-    else:  # multiple matches
-        matches2 = [t for t in matches if t.get_output_filename(number) == url]
-        assert len(matches2) <= 1
-        return matches2[0] if matches2 else None
+    return TrackIndex(tracks).search(long_name, url, number)
 
 
 def track_from_file(path: Path, playlist_name: str = None) -> Track:
@@ -135,6 +164,27 @@ def track_from_file(path: Path, playlist_name: str = None) -> Track:
     return Track(source, title, subtitle, album, album_artist, artist, genre, tags, path, number, playlist_name)
 
 
+def tracks_from_files(paths: list[Path], playlist_name: str = None, cache: FileCache = None, max_workers: int = None) -> list[Track]:
+    """
+    Load many tracks like `track_from_file`.
+    Metadata of unchanged files is taken from `cache`; cache misses are read in parallel on a thread pool and added to the cache.
+    """
+    tracks: list[Track | None] = [None] * len(paths)
+    misses = []
+    for i, path in enumerate(paths):
+        cached = cache.get(path) if cache is not None else None
+        if cached is not None:
+            tracks[i] = Track(**cached, file_path=path, playlist_name=playlist_name)
+        else:
+            misses.append(i)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for i, track in zip(misses, pool.map(lambda i: track_from_file(paths[i], playlist_name), misses)):
+            tracks[i] = track
+            if cache is not None:
+                cache.put(paths[i], {**track.cache_dict(), 'number': track.number})
+    return tracks
+
+
 def get_url_from_comments(comments: list[str]):
     valid_urls = []
     for comment in comments:
@@ -149,12 +199,10 @@ def get_url_from_comments(comments: list[str]):
     return max(valid_urls, key=lambda url: len(url))
 
 
-def check_no_duplicates(tracks: list[Track]):
-    for i, t1 in enumerate(tracks):
-        for t2 in tracks[i+1:]:
-            if t1 is not None and t2 is not None:
-                if t1.long_name == t2.long_name:
-                    raise AssertionError(f"Duplicate songs with name {t1.long_name}")
+def check_no_duplicates(tracks: list[Track | None]):
+    duplicates = TrackIndex(tracks).duplicates()
+    if duplicates:
+        raise AssertionError(f"{len(duplicates)} duplicate songs:\n" + "\n".join(f"  {name} ({len(matches)}x)" for name, matches in duplicates.items()))
 
 
 # if __name__ == '__main__':
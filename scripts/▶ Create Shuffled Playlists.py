@@ -1,18 +1,30 @@
+import argparse
 import json
+import shutil
+import sys
+import time
+import traceback
 from pathlib import Path
 
-from html_gen.generate import generate_playlist_html
-from order_opt.simulated_annealing import simulated_annealing, greedy_fill
-from process_mp3.compress import compress_mp3_vbr_parallel
-from process_mp3.tracks import track_from_file, Track, search_track, slugify, check_no_duplicates
+import build_trace
+from build_state import BuildState, directory_fingerprint
+from build_trace import stage
+from process_mp3.cache import FileCache
 
+# numpy, scipy and mutagen are only imported once a playlist actually needs to be rebuilt
 
-def create_shuffled_playlist(src_dir: Path, amend: bool, create_preview: bool):
+VBR_QUALITY = 7  # LAME VBR quality of the hosted MP3s
+
+
+def create_shuffled_playlist(src_dir: Path, amend: bool, create_preview: bool, chains: int = 1, seed: int = None, metadata_cache: FileCache = None, progress=None, adaptive=False, patience: int = None, time_budget: float = None, optimizer='annealing', exclude: set[Path] = frozenset()):
+    from order_opt.local_search import local_search
+    from order_opt.simulated_annealing import simulated_annealing, greedy_fill
+    from process_mp3.tracks import tracks_from_files, Track, TrackIndex, slugify, check_no_duplicates
     playlist_name = src_dir.name.split("(", 1)[0].strip()
     output_dir = Path(__file__).parent.parent / 'docs' / 'audio' / slugify(playlist_name)
     if output_dir.is_dir():
         for file in output_dir.iterdir():
-            if file.name.endswith('.mp3'):
+            if file.name.endswith('.mp3') or (file.name.startswith('.') and file.name.endswith('.part')):  # including leftovers of interrupted encodes
                 file.unlink(missing_ok=True)
     preview_dir = Path(__file__).parent.parent / 'preview-audio' / slugify(playlist_name)
     if create_preview and preview_dir.is_dir():
@@ -30,21 +42,31 @@ def create_shuffled_playlist(src_dir: Path, amend: bool, create_preview: bool):
     else:
         playlist_data = {'majorVersion': 0, 'minorVersion': 0, 'tracks': []}
     # --- Discover tracks & shuffle ---
-    all_tracks = [track_from_file(file, playlist_name) for file in src_dir.iterdir() if file.name.endswith('.mp3')]
+    with stage('scan', playlist_name):
+        all_tracks = tracks_from_files([file for file in sorted(src_dir.iterdir()) if file.name.endswith('.mp3') and file not in exclude], playlist_name, metadata_cache)
     if amend:
-        for i, existing in enumerate(playlist_data['tracks'], 1):
-            matching_track = search_track(existing['full'], existing['url'], i, all_tracks)
-            if matching_track:
-                matching_track.number = i
-            else:
-                print(f"Track removed: {existing['name']}")
+        with stage('match', playlist_name):
+            index = TrackIndex(all_tracks)
+            for i, existing in enumerate(playlist_data['tracks'], 1):
+                matching_track = index.search(existing['full'], existing['url'], i)
+                if matching_track:
+                    matching_track.number = i
+                else:
+                    print(f"Track removed: {existing['name']}")
     ordered = [None] * len(all_tracks)
     for track in all_tracks:
         if track.number is not None:
             ordered[track.number - 1] = track
     remaining = [t for t in all_tracks if t.number is None]
-    ordered = greedy_fill(ordered, remaining)
-    ordered, loss = simulated_annealing(ordered, iterations_per_temp=2*len(remaining))
+    with stage('greedy_fill', playlist_name):
+        ordered = greedy_fill(ordered, remaining, seed)
+    if optimizer == 'local-search':
+        with stage('local_search', playlist_name):
+            ordered, loss = local_search(ordered, time_budget=time_budget)
+    else:
+        with stage('anneal', playlist_name):
+            ordered, loss = simulated_annealing(ordered, iterations_per_temp=2*len(remaining), chains=chains, seed=seed, progress=progress,
+                                                adaptive=adaptive, patience=patience if adaptive else None, time_budget=time_budget)
     check_no_duplicates(ordered)
     print("Ordering loss per element:", loss / len(ordered))
     # --- Shuffle & write ---
@@ -72,11 +94,211 @@ def create_shuffled_playlist(src_dir: Path, amend: bool, create_preview: bool):
     return playlist_file, playlist_name, hosted_src, hosted_dst
 
 
-if __name__ == "__main__":
-    ROOT = Path(__file__).parent.parent
-    for playlist_dir in (ROOT / 'source_playlists').iterdir():
-        if not playlist_dir.name.startswith('_'):
+def add_stream_urls(playlist_file: Path, streams: dict[str, str]):
+    """ Add the HLS manifest URLs, relative to the playlist's audio directory, to the tracks of a playlist file, keyed by their MP3 file name. """
+    with playlist_file.open('r', encoding='utf-8') as f:
+        playlist_data = json.load(f)
+    for track in playlist_data['tracks']:
+        if track['url'] in streams:
+            track['stream'] = streams[track['url']]
+    with playlist_file.open('w', encoding='utf-8') as f:
+        json.dump(playlist_data, f, indent=2)
+
+
+def print_progress(every: int):
+    """ Progress callback for `simulated_annealing` that prints every `every`-th temperature step. """
+    step = 0
+
+    def progress(temp: float, loss_per_element: float, acceptance_rate: float):
+        nonlocal step
+        if step % every == 0:
+            print(f"  T={temp:9.4f}  loss/element={loss_per_element:.5f}  accepted={acceptance_rate:.1%}")
+        step += 1
+    return progress
+
+
+def select_playlists(playlist_dirs: list[Path], names: list[str]) -> list[Path]:
+    """ Source directories matching the given names, compared case-insensitively with and without the part in parentheses. """
+    selected = []
+    for name in names:
+        matches = [d for d in playlist_dirs if name.lower() in (d.name.lower(), d.name.split("(", 1)[0].strip().lower())]
+        if not matches:
+            raise ValueError(f"No playlist named '{name}'. Available: {', '.join(d.name for d in playlist_dirs)}")
+        selected.extend(m for m in matches if m not in selected)
+    return selected
+
+
+class PlaylistBuilder:
+    """
+    Rebuilds playlists and the site, keeping all caches of the session in memory.
+    Used once for a normal run and repeatedly in watch mode.
+
+    Only the file caches (metadata, audio hashes, loudness, fingerprints) stay resident, so a rebuild reads no unchanged file.
+    `Track` objects and weight matrices are recreated from them on every rebuild: this takes tens of milliseconds per 1000 tracks,
+    while reusing them would carry over the track numbers assigned by the previous ordering.
+    """
+
+    def __init__(self, root: Path, args: argparse.Namespace):
+        self.root = root
+        self.args = args
+        self.state = BuildState(root / '.cache' / 'build_state.json')
+        self.progress = print_progress(250 if args.verbose == 1 else 1) if args.verbose else None
+        self._caches = None
+
+    @property
+    def stream(self) -> bool:
+        """ Whether `--stream` is given and the vendored hls.js is available, without which players fall back to the MP3s. """
+        from html_gen.generate import HLS_JS
+        return self.args.stream and HLS_JS.is_file()
+
+    def playlist_dirs(self) -> list[Path]:
+        return sorted(d for d in (self.root / 'source_playlists').iterdir() if d.is_dir() and not d.name.startswith('_'))
+
+    def fingerprints(self) -> dict[str, str]:
+        """ Fingerprint of each source directory, including the options that change what is built from it. """
+        options = " ".join(option for option, enabled in [("stream", self.stream), ("skip-duplicates", self.args.duplicates == 'skip')] if enabled)
+        return {d.name: directory_fingerprint(d, extra=options) for d in self.playlist_dirs()}
+
+    def site_fingerprint(self) -> str:
+        return directory_fingerprint(Path(__file__).parent / 'html_gen', ('.html', '.py'), f"release={self.args.release}" + (" zip" if self.args.zip else "")) + directory_fingerprint(self.root / 'playlists', ('.json',))
+
+    def caches(self):
+        if self._caches is None:  # imports mutagen
+            from process_mp3.compress import EncodeStore
+            self._caches = (FileCache(self.root / '.cache' / 'metadata.jsonl'),
+                            EncodeStore(self.root / '.cache' / 'encodes', FileCache(self.root / '.cache' / 'audio_hashes.jsonl')),
+                            FileCache(self.root / '.cache' / 'loudness.jsonl'),
+                            FileCache(self.root / '.cache' / 'fingerprints.jsonl'))
+        return self._caches
+
+    def find_duplicates(self, todo: list[Path]) -> dict[Path, tuple[Path, float]]:
+        """
+        Source files across all playlists whose audio matches an earlier file (by playlist and file name), ignoring tags.
+        Duplicates within the playlists in `todo` are reported.
+        """
+        from process_mp3.fingerprint import fingerprint_parallel, find_duplicates
+        fingerprint_cache = self.caches()[3]
+        paths = [file for d in self.playlist_dirs() for file in sorted(d.iterdir()) if file.name.endswith('.mp3')]
+        with stage('dedup'):
+            duplicates = find_duplicates(paths, fingerprint_parallel(paths, fingerprint_cache))
+            fingerprint_cache.save()
+        for path, (original, ber) in duplicates.items():
+            if path.parent in todo:
+                print(f"⚠️ Duplicate audio ({1 - ber:.0%} similar): '{path.parent.name}/{path.name}' matches '{original.parent.name}/{original.name}'" + (", skipping" if self.args.duplicates == 'skip' else ""))
+        return duplicates
+
+    def build(self, todo: list[Path], fingerprints: dict[str, str]):
+        """ Rebuild the playlists in `todo` and re-render the site. `fingerprints` of the current source directories are recorded for successfully built playlists. """
+        from html_gen.generate import HLS_JS, HLS_JS_URL, copy_hls_js, generate_playlist_html
+        from process_mp3.compress import compress_mp3_vbr_parallel
+        from process_mp3.loudness import measure_loudness_parallel, normalization_gain
+        from process_mp3.segment import segment_parallel
+        from process_mp3.tracks import slugify
+        args = self.args
+        trace = build_trace.BuildTrace(args.profile, self.root / '.cache' / 'profiles')
+        build_trace.activate(trace)
+        metadata_cache, encode_store, loudness_cache, _ = self.caches()
+        keep = set(fingerprints) | {'__site__'}
+        if self.stream:
+            copy_hls_js(self.root / 'docs')
+        elif args.stream:
+            print(f"⚠️ {HLS_JS} is missing, playing the MP3s without streaming. Download it from {HLS_JS_URL} to enable HLS")
+        duplicates = self.find_duplicates(todo) if todo and args.duplicates != 'off' else {}
+        exclude = set(duplicates) if args.duplicates == 'skip' else frozenset()
+        for playlist_dir in todo:
             print(f"Creating playlist from '{playlist_dir.name}'")
-            file, name, hosted_tracks, hosted_paths = create_shuffled_playlist(playlist_dir, amend=True, create_preview=True)
-            compress_mp3_vbr_parallel(hosted_tracks, hosted_paths, overwrite=False)
-    generate_playlist_html(ROOT / 'playlists', ROOT / 'docs')
+            file, name, hosted_tracks, hosted_paths = create_shuffled_playlist(playlist_dir, amend=True, create_preview=True, metadata_cache=metadata_cache, progress=self.progress, adaptive=args.adaptive, patience=args.patience, time_budget=args.time_budget, optimizer=args.optimizer, exclude=exclude, chains=args.chains, seed=args.seed)
+            with stage('loudness', name):
+                loudness = measure_loudness_parallel([t.file_path for t in hosted_tracks], loudness_cache)
+                loudness_cache.save()
+            gains = [normalization_gain(l) for l in loudness]
+            with stage('encode', name):
+                compress_mp3_vbr_parallel(hosted_tracks, hosted_paths, VBR_QUALITY, overwrite=False, store=encode_store, gains=gains, label=f"{name} ")
+            stream_dir = self.root / 'docs' / 'audio' / slugify(name) / 'hls'
+            if self.stream:
+                with stage('segment', name):
+                    local = [(track, path, gain) for track, path, gain in zip(hosted_tracks, hosted_paths, gains) if not track.is_hosted_externally]
+                    mp3s = [path for _, path, _ in local]
+                    keys = [encode_store.file(track.file_path, VBR_QUALITY, gain).stem[:16] for track, _, gain in local]
+                    manifests = segment_parallel(mp3s, keys, stream_dir)
+                add_stream_urls(file, {mp3.name: manifest.relative_to(mp3.parent).as_posix() for mp3, manifest in zip(mp3s, manifests)})
+            elif stream_dir.is_dir():
+                shutil.rmtree(stream_dir)
+            metadata_cache.save()
+            self.state.update(playlist_dir.name, fingerprints[playlist_dir.name])
+            self.state.save(keep)
+        with stage('html'):
+            generate_playlist_html(self.root / 'playlists', self.root / 'docs', self.root / '.cache' / 'html_manifest.json', release=args.release, bundle=args.zip)
+        self.state.update('__site__', self.site_fingerprint())
+        self.state.save(keep)
+        build_trace.activate(None)
+        print(trace.summary())
+        if args.trace:
+            trace.save(args.trace)
+
+    def watch(self, interval: float, debounce: float):
+        """
+        Poll the source directories and rebuild playlists whose files changed.
+        A rebuild starts once the fingerprints have been stable for `debounce` seconds, so files that are still being copied or tagged are not picked up half-way.
+        Failed rebuilds are reported and retried only after the playlist changes again.
+        """
+        print(f"Watching {self.root / 'source_playlists'} for changes. Press Ctrl+C to stop.")
+        last, last_change = None, time.monotonic()
+        failed: dict[str, str] = {}
+        while True:
+            fingerprints = self.fingerprints()
+            if fingerprints != last:
+                last, last_change = fingerprints, time.monotonic()
+            elif time.monotonic() - last_change >= debounce:
+                todo = [d for d in self.playlist_dirs() if self.state.changed(d.name, fingerprints[d.name]) and failed.get(d.name) != fingerprints[d.name]]
+                if todo or self.state.changed('__site__', self.site_fingerprint()):
+                    try:
+                        self.build(todo, fingerprints)
+                    except Exception:
+                        build_trace.activate(None)
+                        traceback.print_exc()
+                        print(f"❌ Rebuild failed, waiting for further changes")
+                        failed.update({d.name: fingerprints[d.name] for d in todo if self.state.changed(d.name, fingerprints[d.name])})
+                    print("Watching for changes...")
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shuffle, encode and publish the playlists in source_playlists/. Only playlists whose source files changed since the last build are rebuilt.")
+    parser.add_argument('playlists', nargs='*', help="Rebuild only these playlists (source directory names, with or without the part in parentheses), even if unchanged")
+    parser.add_argument('--force', action='store_true', help="Rebuild all playlists, even if unchanged")
+    parser.add_argument('--watch', action='store_true', help="Keep running and rebuild playlists whenever their source files change")
+    parser.add_argument('--interval', type=float, default=1., help="Polling interval of --watch in seconds")
+    parser.add_argument('--debounce', type=float, default=2., help="Seconds without further changes before --watch starts a rebuild")
+    parser.add_argument('--duplicates', choices=['report', 'skip', 'off'], default='report', help="Find source files with the same audio by fingerprint across all playlists. 'skip' leaves later copies out of the playlists")
+    parser.add_argument('--stream', action='store_true', help="Also split the hosted MP3s into HLS segments so the player can start before a track is fully loaded. Requires html_gen/vendor/hls.min.js")
+    parser.add_argument('--zip', action='store_true', help="Also pack the hosted MP3s of each playlist into one uncompressed ZIP linked from the download page. Playlists over 95 MB, which GitHub would reject, keep the in-browser download")
+    parser.add_argument('--release', action='store_true', help="Minify and precompress the generated pages")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Print annealing progress (-v: every 250th temperature step, -vv: every step)")
+    parser.add_argument('--optimizer', choices=['annealing', 'local-search'], default='annealing', help="Ordering optimizer run after the greedy fill")
+    parser.add_argument('--seed', type=int, help="Random seed of the shuffle. A given seed reproduces the same playlists from the same sources")
+    parser.add_argument('--chains', type=int, default=1, help="Number of independent annealing chains; chains beyond the first run in worker processes")
+    parser.add_argument('--adaptive', action='store_true', help="Use the adaptive annealing schedule with early stopping")
+    parser.add_argument('--patience', type=int, default=300, help="With --adaptive, stop annealing after this many temperature steps without improvement")
+    parser.add_argument('--time-budget', type=float, help="Maximum optimization time per playlist in seconds")
+    parser.add_argument('--trace', type=Path, help="Write a JSON trace of stage timings and counters to this file")
+    parser.add_argument('--profile', nargs='+', default=(), metavar='STAGE', help="Run these stages under cProfile (dedup, scan, match, greedy_fill, anneal, local_search, loudness, encode, segment, html)")
+    args = parser.parse_args()
+    builder = PlaylistBuilder(Path(__file__).parent.parent, args)
+    # --- Change detection (cheap, no heavy imports) ---
+    playlist_dirs = builder.playlist_dirs()
+    fingerprints = builder.fingerprints()
+    try:
+        todo = select_playlists(playlist_dirs, args.playlists) if args.playlists else [d for d in playlist_dirs if args.force or builder.state.changed(d.name, fingerprints[d.name])]
+    except ValueError as err:
+        parser.error(str(err))
+    if todo or builder.state.changed('__site__', builder.site_fingerprint()):
+        builder.build(todo, fingerprints)
+    elif not args.watch:
+        print("Nothing changed.")
+        sys.exit(0)
+    if args.watch:
+        try:
+            builder.watch(args.interval, args.debounce)
+        except KeyboardInterrupt:
+            print("Stopped watching.")